@@ -2,18 +2,68 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 """Omen2: generate python code from a database schema."""
-import argparse
+import ast
+import functools
+import hashlib
 import keyword
 import os
 import sys
 import importlib
 import importlib.util
+import io
 import logging as log
 from types import ModuleType
+from typing import Dict, Tuple
 
 from notanorm import DbTable, DbCol
 
-from omen2.types import default_type, any_type
+import omen2.types
+from omen2.types import default_type, any_type, string_type
+
+# generated modules already exec'ed, keyed by (path, module name)
+# each entry holds the file's (inode, mtime, size) too, a rewritten file replaces it
+_GEN_CACHE: Dict[Tuple[str, str], Tuple[Tuple[int, int, int], ModuleType]] = {}
+
+# python reserved words, column names matching these get a trailing underscore
+_KEYWORDS = frozenset(keyword.kwlist)
+
+# first line of generated files, lets unchanged models skip regeneration
+_KEY_PREFIX = "# omen2-codegen: "
+
+
+@functools.lru_cache(maxsize=None)
+def _codegen_source() -> bytes:
+    # generated defaults and annotations come from omen2.types too
+    src = []
+    for path in (__file__, omen2.types.__file__):
+        with open(path, "rb") as f:
+            src.append(f.read())
+    return b"".join(src)
+
+
+# one row class, table class and relation class per db table
+_CLASS_TEMPLATE = """\
+class {name}_row(ObjBase):
+{annotations}\
+    _pk = {pk_names}
+    __match_args__ = {col_list}
+
+    def __init__(self, *, {params}):
+{assigns}\
+        super().__init__(**kws)
+
+{name}_row_type_var = TypeVar('{name}_row_type_var', bound={name}_row)
+
+class {name}(Table[{name}_row_type_var]):
+    table_name = "{name}"
+    row_type = {name}_row
+    field_names_tuple = {col_list}
+    field_names = frozenset(field_names_tuple)
+
+
+class {name}_relation(Relation[{name}_row]):
+    table_type = {name}
+"""
 
 
 class CodeGen:
@@ -24,9 +74,17 @@ class CodeGen:
 
         Args:
             module_path: package.module.ClassName
+            class_type: the class itself, if already imported
         """
         self.path = module_path
-        self.package, self.module, self.class_name = self.parse_class_path(self.path)
+        if class_type is not None:
+            # already have the class, no need to parse the path or import anything
+            self.package, _, self.module = class_type.__module__.rpartition(".")
+            self.class_name = class_type.__name__
+        else:
+            self.package, self.module, self.class_name = self.parse_class_path(
+                self.path
+            )
         if self.module == "__main__":
             self.module, _ = os.path.splitext(
                 os.path.basename(
@@ -40,23 +98,13 @@ class CodeGen:
         # if this isn't good enough, you're using some weird db column names
         tab: DbTable
         for name, tab in list(self.model.items()):
-            new_cols = []
-            need_tab = False
-            for col in tab.columns:
-                new_coldef = col._asdict()
-                need_col = False
-                if keyword.iskeyword(col.name):
-                    new_coldef["name"] = col.name + "_"
-                    need_col = True
-                if need_col:
-                    new_col = DbCol(**new_coldef)
-                    need_tab = True
-                else:
-                    new_col = col
-                new_cols.append(new_col)
-            if need_tab:
-                new_tab = DbTable(columns=tuple(new_cols), indexes=tab.indexes)
-                self.model[name] = new_tab
+            if not any(col.name in _KEYWORDS for col in tab.columns):
+                continue
+            new_cols = tuple(
+                col._replace(name=col.name + "_") if col.name in _KEYWORDS else col
+                for col in tab.columns
+            )
+            self.model[name] = DbTable(columns=new_cols, indexes=tab.indexes)
 
     @staticmethod
     def gen_class(out, name, dbtab: "DbTable"):
@@ -79,103 +127,73 @@ class CodeGen:
 
         """
 
-        # *** ROW DEFINITION ***
-        print("class " + name + "_row(ObjBase):", file=out)
-
         # keys is the set of fields to be used for the primary key
         # if there is no primary key, then we use "all columns"
-        keys = [col.name for col in dbtab.columns]
+        keys = None
         for index in dbtab.indexes:
             if index.primary and index.fields:
-                keys = index.fields
+                # depending on the notanorm version, these are names or DbIndexField's
+                keys = [k if isinstance(k, str) else k.name for k in index.fields]
 
+        # single pass over the columns, each section below is emitted from these
+        col_names = []
+        annotations = []
+        params = []
         for col in dbtab.columns:
             pytype = default_type(col.typ)
             typename = pytype.__name__
-            if not col.notnull and pytype is not any_type:
-                typename = "Optional[%s]" % typename
-            print("    %s: %s" % (col.name, typename), file=out)
-
-        # _pk is a class-variable
-        print(
-            "    _pk = ('"
-            + "', '".join([k if type(k) is str else k.name for k in keys])
-            + "', )",
-            file=out,
-        )
-        print("", file=out)
+            col_names.append(col.name)
 
-        # generate an init statement for the new class
-        print("    def __init__(self, *, ", file=out, end="")
-        for col in dbtab.columns:
-            pytype = default_type(col.typ)
-            name_and_type = col.name + ": " + pytype.__name__
-            # we're in the init parameter line: `color: str`
-            print(name_and_type, file=out, end="")
+            # class annotation: `color: Optional[str]`
+            if not col.notnull and pytype is not any_type:
+                annotations.append(f"    {col.name}: Optional[{typename}]\n")
+            else:
+                annotations.append(f"    {col.name}: {typename}\n")
 
+            # init parameter: `color: str = 'green'`
+            param = f"{col.name}: {typename}"
             if col.default is not None or not col.notnull:
-                # derive default value from the db default value
-                if col.default is not None:
-                    try:
-                        # check valid python
-                        defval = pytype(str(col.default))  # pylint: disable=eval-used
-                    except (ValueError, NameError):
-                        # no way to generate a default value for some stuff
-                        defval = None
-                        log.warning(
-                            "not generating python default for %s.%s=%s",
-                            name,
-                            col.name,
-                            col.default,
-                        )
-                else:
-                    defval = None
-                # double check
-                eval(str(defval))  # pylint: disable=eval-used
-                # finishing one parameter: = "green"
-                print(" = " + str(defval), file=out, end="")
-            # comma between params
-            print(", ", file=out, end="")
-        # extra kws pass thru
-        print("**kws):", file=out)
-
-        # from above: self.color = color
-        for col in dbtab.columns:
-            print("        self." + col.name + " = " + col.name, file=out)
-
-        # call to super init
-        print("        super().__init__(**kws)", file=out)
-
-        # newline
-        print(file=out)
-
-        # other class-level variables
-        print(
-            name
-            + "_row_type_var = TypeVar('"
-            + name
-            + "_row_type_var', bound="
-            + name
-            + "_row)",
-            file=out,
-        )
-
-        # *** TABLE DEFINITION ***
-        print(file=out)
-        print("class " + name + "(Table[" + name + "_row_type_var]):", file=out)
-        print('    table_name = "' + name + '"', file=out)
-        print("    row_type = " + name + "_row", file=out)
-        print(
-            "    field_names = {'"
-            + "', '".join(col.name for col in dbtab.columns)
-            + "'}",
-            file=out,
+                param += " = " + CodeGen._default_expr(name, col, pytype)
+            params.append(param)
+        # extra kws pass thru to ObjBase
+        params.append("**kws")
+
+        if keys is None:
+            keys = col_names
+
+        out.write(
+            _CLASS_TEMPLATE.format(
+                name=name,
+                annotations="".join(annotations),
+                pk_names=repr(tuple(keys)),
+                col_list=repr(tuple(col_names)),
+                params=", ".join(params),
+                assigns="".join(f"        self.{c} = {c}\n" for c in col_names),
+            )
         )
 
-        # *** RELATION DEFINITION ***
-        print("\n", file=out)
-        print("class " + name + "_relation(Relation[" + name + "_row]):", file=out)
-        print("    table_type = " + name, file=out)
+    @staticmethod
+    def _default_expr(name, col: DbCol, pytype) -> str:
+        """Python source for the init default of a nullable or defaulted column."""
+        if col.default is None:
+            return "None"
+        # derive default value from the db default value
+        try:
+            defval = pytype(str(col.default))
+            if pytype is string_type:
+                # already a quoted literal, make sure it's one python can read
+                ast.literal_eval(defval)
+        except (ValueError, SyntaxError):
+            # no way to generate a default value for some stuff
+            log.warning(
+                "not generating python default for %s.%s=%s",
+                name,
+                col.name,
+                col.default,
+            )
+            return "None"
+        # string_type already returns a quoted literal, everything else is a value
+        return defval if pytype is string_type else repr(defval)
 
     def output_path(self):
         """Get the codegen output path.
@@ -184,33 +202,50 @@ class CodeGen:
         """
         base_path = sys.modules[self.base_cls.__module__].__file__
         path, _ = os.path.splitext(base_path)
-        path = path + "_gen.py"
+        path = f"{path}_gen.py"
         return path
 
     @staticmethod
     def gen_import(out):
         """Generate import statements."""
-        print(
+        out.write(
             "from omen2 import ObjBase, Table, Relation, any_type\n"
-            "from typing import TypeVar, Optional, Any\n",
-            file=out,
+            "from typing import TypeVar, Optional, Any\n\n"
         )
 
+    def model_key(self) -> str:
+        """Hash of the model, the code generator and its types: identifies the generated output."""
+        h = hashlib.sha256(_codegen_source())
+        for name, tab in self.model.items():
+            # indexes are a set, sort them so the key is stable across runs
+            indexes = sorted(repr(index) for index in tab.indexes)
+            h.update(repr((name, tab.columns, indexes)).encode("utf8"))
+        return h.hexdigest()
+
+    def is_current(self, path) -> bool:
+        """True if the file at path was generated from this same model."""
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                first = f.readline()
+        except FileNotFoundError:
+            return False
+        return first.rstrip("\n") == _KEY_PREFIX + self.model_key()
+
     def gen_monolith(self, out):
         """Generates a single, monolithic file with all classes in one file."""
+        out.write(f"{_KEY_PREFIX}{self.model_key()}\n")
         self.gen_import(out)
 
         for name, dbtab in self.model.items():
             self.gen_class(out, name, dbtab)
-            print("\n", file=out)
-        print(
-            '__all__ = ["' + '", "'.join(name for name in self.model) + '"]', file=out
-        )
+            out.write("\n\n")
+        names = '", "'.join(self.model)
+        out.write(f'__all__ = ["{names}"]\n')
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def parse_class_path(path):
         """Parse the package.module.ClassName path."""
-        sys.path = [os.getcwd()] + sys.path
         parts = path.split(".")
         cls = parts[-1]
         module = parts[-2]
@@ -219,6 +254,10 @@ class CodeGen:
 
     def import_mod(self):
         """Import the module this codegen will be running on."""
+        # command line use: module paths are relative to the cwd
+        cwd = os.getcwd()
+        if cwd not in sys.path:
+            sys.path.insert(0, cwd)
         pack_mod = ".".join(n for n in (self.package, self.module) if n)
         if pack_mod in sys.modules:
             module = sys.modules[pack_mod]
@@ -231,12 +270,21 @@ class CodeGen:
         """Import the module this codegen generated."""
         gen_name = self.module + "_gen"
         module_name = self.package + "." + gen_name if self.package else gen_name
-        with open(out_path, "r", encoding="utf8") as f:
-            code = compile(f.read(), out_path, "exec")
+        stat = os.stat(out_path)
+        # regeneration swaps in a new file with os.replace, which changes the inode
+        sig = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = (out_path, module_name)
+        cached = _GEN_CACHE.get(key)
+        if cached is not None and cached[0] == sig:
+            module = cached[1]
+        else:
+            with open(out_path, "r", encoding="utf8") as f:
+                code = compile(f.read(), out_path, "exec")
             module = ModuleType(module_name, "generated from %s" % self.module)
             module.__file__ = out_path
             exec(code, module.__dict__)  # pylint: disable=exec-used
-            sys.modules[module_name] = module
+            _GEN_CACHE[key] = (sig, module)
+        sys.modules[module_name] = module
         if self.package:
             parent = importlib.import_module(self.package)
             setattr(parent, gen_name, module)
@@ -254,9 +302,15 @@ class CodeGen:
         cg = CodeGen(class_path, class_type)
 
         dest_path = out_path or cg.output_path()
+        if cg.is_current(dest_path):
+            return cg.import_generated(dest_path)
+
         tmp_path = dest_path + ".tmp"
-        with open(tmp_path, "w", encoding="utf8") as outf:
-            cg.gen_monolith(outf)
+        # generate in memory, then write the file in one go
+        buf = io.StringIO()
+        cg.gen_monolith(buf)
+        with open(tmp_path, "wb") as outf:
+            outf.write(buf.getvalue().encode("utf8"))
 
         os.replace(tmp_path, dest_path)
 
@@ -265,6 +319,9 @@ class CodeGen:
 
 def main():
     """Command line codegen: given a moddule path, generate code."""
+    # only needed on the command line, not when omen2 is imported
+    import argparse  # pylint: disable=import-outside-toplevel
+
     parser = argparse.ArgumentParser(description="Generate omen2 database-linked code")
     parser.add_argument(
         "module",
@@ -3,6 +3,9 @@
 
 """Many-to-many relationship helper.   Provides nice syntax for interacting with m2m relationships."""
 
+import functools
+import operator
+
 from omen2.object import ObjBase
 from omen2.errors import OmenKeyError
 
@@ -16,17 +19,31 @@ from typing import (
     Optional,
     List,
     Generator,
+    Iterable,
+    Any,
+    Callable,
 )
 
 from .relation import Relation
+from .table import Table
 
 if TYPE_CHECKING:
-    from omen2 import Omen, Table, Relation
+    from omen2 import Omen
 
 T1 = TypeVar("T1", bound="ObjBase")
 T2 = TypeVar("T2", bound="ObjBase")
 
 
+def _where_getter(where: dict) -> Callable[[Any], dict]:
+    """Callable that resolves {field: other field} to {field: value of obj.<other field>}."""
+    keys = tuple(where.keys())
+    get = operator.attrgetter(*where.values())
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda obj: {key: get(obj)}
+    return lambda obj: dict(zip(keys, get(obj)))
+
+
 class M2MMixObj(Generic[T1, T2]):
     """Mixes two objects and returns the hybrid.
 
@@ -37,33 +54,34 @@ class M2MMixObj(Generic[T1, T2]):
 
     # pylint: disable=protected-access
 
-    __ready = False
-    _obj1 = None
-    _obj2 = None
+    # one of these is made per m2m row selected, no need for an instance dict
+    __slots__ = ("_obj1", "_obj2")
+
+    _is_omen_obj = True
 
     def __init__(self, obj1: T1, obj2: T2):
-        self._obj1 = obj1
-        self._obj2 = obj2
-        self.__ready = True
+        # bypass __setattr__, which forwards everything to obj1/obj2
+        object.__setattr__(self, "_obj1", obj1)
+        object.__setattr__(self, "_obj2", obj2)
 
     def __repr__(self):
         return self.__class__.__name__ + repr((self._obj1, self._obj2))
 
+    def __owner(self, key):
+        """Obj1 if it has the attribute, otherwise obj2: dict/set lookups instead of hasattr."""
+        obj1 = self._obj1
+        if key in obj1.__dict__ or key in type(obj1)._class_attr_names():
+            return obj1
+        return self._obj2
+
     def __getattr__(self, key):
-        if hasattr(self._obj1, key):
-            return getattr(self._obj1, key)
-        return getattr(self._obj2, key)
+        if key in M2MMixObj.__slots__:
+            # not initialized yet (copy, unpickle), don't recurse into __owner
+            raise AttributeError(key)
+        return getattr(self.__owner(key), key)
 
     def __setattr__(self, key, val):
-        if not self.__ready:
-            object.__setattr__(self, key, val)
-            return
-
-        if not hasattr(self._obj1, key):
-            setattr(self._obj2, key, val)
-            return
-
-        setattr(self._obj1, key, val)
+        setattr(self.__owner(key), key, val)
 
     def __enter__(self):
         self._obj1.__enter__()
@@ -74,16 +92,28 @@ class M2MMixObj(Generic[T1, T2]):
         self._obj2.__exit__(exc_type, exc_val, exc_tb)
         self._obj1.__exit__(exc_type, exc_val, exc_tb)
 
+    # comparisons go through the objects' own __eq__/__lt__, which users may override,
+    # identity checks skip building pk dicts when the same row is shared
     def __eq__(self, other: "M2MMixObj"):
-        return self._obj1 == other._obj1 and self._obj2 == other._obj2
+        if self is other:
+            return True
+        if not isinstance(other, M2MMixObj):
+            return NotImplemented
+        obj1, obj2 = self._obj1, self._obj2
+        return (obj1 is other._obj1 or obj1 == other._obj1) and (
+            obj2 is other._obj2 or obj2 == other._obj2
+        )
 
     def __lt__(self, other: "M2MMixObj"):
-        ret = (
-            self._obj1 < other._obj1
-            or self._obj1 == other._obj1
-            and self._obj2 < other._obj2
-        )
-        return ret
+        if not isinstance(other, M2MMixObj):
+            return NotImplemented
+        obj1, other1 = self._obj1, other._obj1
+        if obj1 is not other1:
+            if obj1 < other1:
+                return True
+            if obj1 != other1:
+                return False
+        return self._obj2 < other._obj2
 
 
 ROW_TYPE = Union[T2, M2MMixObj[T1, T2]]
@@ -118,6 +148,14 @@ class M2MHelper(Relation[ROW_TYPE]):
         """Row type of the related table."""
         return self.table_type_2.row_type
 
+    @property
+    def need_mixin(self) -> bool:
+        """True if the m2m table has fields beyond the joins, and results are mixins."""
+        field_names = getattr(self.table_type, "field_names", None)
+        if not field_names:
+            return True
+        return len(field_names) > len(self.__field_map[0]) + len(self.__field_map[1])
+
     def __init__(
         self,
         _from: "ObjBase",
@@ -135,17 +173,16 @@ class M2MHelper(Relation[ROW_TYPE]):
             where:  tuple(where_dict for self, where_dict for related)
         """
         self.__saved: List[M2MMixObj] = []
-        self.__field_map = where
+        # (m2m field, other field) pairs for each side, and getters resolving them from objects
+        self.__field_map = (tuple(where[0].items()), tuple(where[1].items()))
+        self.__from_getter = _where_getter(where[0])
+        self.__to_getter = _where_getter(where[1])
         self.__table2: Optional["Table[T2]"] = None
 
-        # relationships use lamdas to get id's from the related table
-        rel_where = where[0].copy()
-
-        def getter_func(v):
-            return lambda: getattr(_from, v)
-
-        for k, v in rel_where.items():
-            rel_where[k] = getter_func(v)
+        # relationships use callables to get id's from the related table
+        rel_where = {
+            k: functools.partial(getattr, _from, v) for k, v in where[0].items()
+        }
 
         self.table_type = types[0]
         self.table_type_2 = types[1]
@@ -159,7 +196,7 @@ class M2MHelper(Relation[ROW_TYPE]):
 
         Memoized getter/shortcut.
         """
-        if not self.__table2:
+        if self.__table2 is None:
             if not self._from._is_bound:
                 return None
             mgr: "Omen" = self._from._table.manager
@@ -167,127 +204,288 @@ class M2MHelper(Relation[ROW_TYPE]):
             self.table_type_2 = type(self.__table2)
         return self.__table2
 
-    def __resolve_where(
-        self, resolved, *, side: int, obj: "ObjBase" = None, invert: bool
-    ):
-        """Convert keywords between relation table and the related tables."""
-        for k, v in self.__field_map[side].items():
-            if invert:
-                resolved[v] = getattr(obj, k)
-            else:
-                if side == 0:
-                    resolved[k] = getattr(self._from, v)
-                else:
-                    resolved[k] = getattr(obj, v)
+    def __from_where(self) -> dict:
+        """Where clause on the m2m table, for rows linked to my source object."""
+        return self.__from_getter(self._from)
+
+    def __to_where(self, obj: "ObjBase") -> dict:
+        """Where clause on the m2m table, for rows linked to obj in the related table."""
+        return self.__to_getter(obj)
 
     # pylint: disable=arguments-renamed
     def add(self, obj_or_id: T2 = None, **kws) -> ROW_TYPE:
         """Add a member of the m2m list, with extra kws for the m2m row."""
 
-        if obj_or_id is None or not isinstance(obj_or_id, (M2MMixObj, ObjBase)):
+        if obj_or_id is None or not getattr(obj_or_id, "_is_omen_obj", False):
             # we have to call "get" on table 2, to get the obj
             # but we want to only use the primary keys of table 2
             # otherwise, we will fail `matches()`
-            kws2 = {}
-            for k in kws.copy():
-                if k in self.row_type_2._pk:
-                    kws2[k] = kws.pop(k)
-            obj = self.table_2.get(obj_or_id, **kws2)
+            table_2 = self.table_2
+            pk_2 = self.row_type_2._pk
+            kws2 = {k: v for k, v in kws.items() if k in pk_2}
+            if kws2:
+                kws = {k: v for k, v in kws.items() if k not in pk_2}
+            obj = table_2.get(obj_or_id, **kws2)
             if not obj:
-                raise OmenKeyError("%s not found" % self.table_2.table_name)
+                raise OmenKeyError("%s not found" % table_2.table_name)
         else:
             obj = obj_or_id
 
-        self.__resolve_where(kws, side=0, invert=False)
-        self.__resolve_where(kws, side=1, obj=obj, invert=False)
+        kws.update(self.__from_where())
+        return self.__add_obj(obj, kws)
+
+    def __add_obj(self, obj: T2, kws: dict) -> ROW_TYPE:
+        """Add the m2m row for obj, kws already has my source object's where values."""
+        kws.update(self.__to_where(obj))
 
-        if not self.table_2:
+        if self.table_2 is None:
             res = self.table_type.row_type(**kws)
             new_mix = M2MMixObj(res, obj)
             self.__saved.append(new_mix)
-            return new_mix
+            return new_mix if self.need_mixin else obj
 
         res = self.table.new(**kws)
         super().add(res)
 
-        return M2MMixObj(res, obj)
+        return M2MMixObj(res, obj) if self.need_mixin else obj
+
+    def add_many(self, objs_or_ids: Iterable[Union[T2, Any]], **kws) -> List[ROW_TYPE]:
+        """Add several members of the m2m list, with the same extra kws for each m2m row.
+
+        Members given by id are looked up with a single select, and the m2m rows are
+        added in one transaction.
+        """
+        items = list(objs_or_ids)
+        table, table_2 = self.table, self.table_2
+        if (
+            table is None
+            or not isinstance(table_2, Table)
+            or table_2._in_tx()
+            or len(self.row_type_2._pk) != 1
+        ):
+            return [self.add(item, **kws) for item in items]
+
+        pk_2 = self.row_type_2._pk[0]
+        ids = [item for item in items if not getattr(item, "_is_omen_obj", False)]
+        found = {}
+        if ids:
+            found = {getattr(obj, pk_2): obj for obj in table_2.select({pk_2: ids})}
+
+        objs = []
+        for item in items:
+            if getattr(item, "_is_omen_obj", False):
+                objs.append(item)
+            elif item in found:
+                objs.append(found[item])
+            else:
+                raise OmenKeyError("%s not found" % table_2.table_name)
+
+        # my source object doesn't change while adding, resolve it once
+        kws.update(self.__from_where())
+        if table._in_tx():
+            return [self.__add_obj(obj, kws.copy()) for obj in objs]
+        with table.transaction():
+            ret = [self.__add_obj(obj, kws.copy()) for obj in objs]
+        return ret
 
     def select(self, _where={}, **kws) -> Generator[ROW_TYPE, None, None]:
         """Select a member of the m2m list.
 
-        Returns mixin objects that represents the relation.
+        Returns mixin objects that represents the relation, or plain related objects
+        if the m2m table has no fields other than the joins.
         """
-        kws2 = {}
-        for k in kws.copy():
-            if k not in self.table_type.field_names:
-                kws2[k] = kws.pop(k)
-
-        kws3 = kws2.copy()
-        for rel in super().select(_where, **kws):
-            # noinspection PyUnboundLocalVariable
-            self.__resolve_where(kws2, side=1, obj=rel, invert=True)
-            for sub in self.table_2.select(kws2):
-                if sub._matches(kws3):
-                    yield M2MMixObj(rel, sub)
+        # keywords that aren't m2m table fields are for the related table
+        field_names = self.table_type.field_names
+        kws2 = {k: v for k, v in kws.items() if k not in field_names}
+        if kws2:
+            kws = {k: v for k, v in kws.items() if k in field_names}
+
+        need_mixin = self.need_mixin
+        table, table_2 = self.table, self.table_2
+        if self.__can_join(table, table_2):
+            for rel, sub in self.__join(table, table_2, {**_where, **kws}, kws2):
+                yield M2MMixObj(rel, sub) if need_mixin else sub
+        elif table_2 is not None:
+            field_map = self.__field_map[1]
+            select_2 = table_2.select
+            for rel in super().select(_where, **kws):
+                where = kws2.copy()
+                for k, v in field_map:
+                    where[v] = getattr(rel, k)
+                # the related table applies kws2 itself, no need to match again
+                for sub in select_2(where):
+                    yield M2MMixObj(rel, sub) if need_mixin else sub
 
         for mix in self.__saved:
-            if mix._obj1._matches(kws):
-                if mix._obj2._matches(kws2):
-                    yield mix
+            rel, sub = mix._obj1, mix._obj2
+            if rel._matches(kws) and sub._matches(kws2):
+                yield mix if need_mixin else sub
+
+    @staticmethod
+    def __can_join(table: Optional["Table"], table_2: Optional["Table"]) -> bool:
+        """True if m2m rows and their related rows can be selected with a db join."""
+        # in-memory matching (cache, open transactions) doesn't see the join
+        # older notanorm versions have no joins, those use the per-row selects
+        return (
+            isinstance(table, Table)
+            and isinstance(table_2, Table)
+            and not table._in_tx()
+            and not table_2._in_tx()
+            and hasattr(table.db, "left_join")
+        )
+
+    @staticmethod
+    def __split_where(table: "Table", where: dict) -> Tuple[dict, dict]:
+        """Split where into db columns, qualified with the table name, and other attributes."""
+        prefix = table.table_name + "."
+        db_where, attr_where = {}, {}
+        for k, v in where.items():
+            if k in table.field_names:
+                db_where[prefix + k] = v
+            else:
+                attr_where[k] = v
+        return db_where, attr_where
+
+    def __join(
+        self, table: "Table[T1]", table_2: "Table[T2]", where, kws2
+    ) -> Generator[Tuple[T1, T2], None, None]:
+        """Select m2m rows and their related rows with a single sql join."""
+        where = {**where, **self.__from_where()}
+        db_where, attr_where = self.__split_where(table, where)
+        db_where_2, attr_where_2 = self.__split_where(table_2, kws2)
+        db = table.db
+        # left join: m2m rows with a missing related row still come back, for cache cleanup
+        join = db.left_join(
+            table.table_name, table_2.table_name, on=dict(self.__field_map[1])
+        )
+        rows = db.select_gen(join, {**db_where, **db_where_2})
+        # filtering on the related table hides m2m rows, then the m2m cache can't be cleaned
+        clean_where = None if db_where_2 else where
+        for rel, sub in self.__load_join(table, table_2, rows, clean_where):
+            if (not attr_where or rel._matches(attr_where)) and (
+                not attr_where_2 or sub._matches(attr_where_2)
+            ):
+                yield rel, sub
+
+    def __load_join(
+        self, table: "Table[T1]", table_2: "Table[T2]", rows, clean_where
+    ) -> Generator[Tuple[T1, T2], None, None]:
+        """Load joined rows through the table caches, cleaning the caches like Table.select."""
+        prefix_2 = table_2.table_name + "."
+        field_map = self.__field_map[1]
+        db_pks = set()
+        for row in rows:
+            row = row._asdict()
+            rel = table._load_join_row(row)
+            db_pks.add(rel._to_pk_tuple())
+            if any(
+                (row[prefix_2 + v] if prefix_2 + v in row else row[v]) is None
+                for _, v in field_map
+            ):
+                # the related row is gone, same as an empty select on the related table
+                table_2._clean_cache({v: getattr(rel, k) for k, v in field_map}, set())
+                continue
+            yield rel, table_2._load_join_row(row)
+        if clean_where is not None:
+            table._clean_cache(clean_where, db_pks)
+
+    def _cascade_objs(self) -> List[T1]:
+        """The m2m rows, not the related rows: those are what cascade with my source object."""
+        return list(super().select()) + [mix._obj1 for mix in self.__saved]
 
     def __call__(self, _id=None, **kws) -> ROW_TYPE:
         """Grab a specific entry by primary key or raise an error."""
         # noinspection PyProtectedMember
         if _id is not None:
             # if the user specifies a positional, we assume they mean the sub-table
-            assert len(self.row_type_2._pk) == 1
-            kws[self.row_type_2._pk[0]] = _id
+            pk_2 = self.row_type_2._pk
+            assert len(pk_2) == 1
+            kws[pk_2[0]] = _id
         return super().__call__(**kws)
 
     def remove(  # pylint: disable=arguments-renamed
         self, obj_or_id: T2 = None, **kws
     ):
         """Remove a specific entry by primary key or raise an error."""
-        if not isinstance(obj_or_id, (ObjBase, M2MMixObj)) or not obj_or_id:
+        if not getattr(obj_or_id, "_is_omen_obj", False) or not obj_or_id:
             # we have to call "get" to get the obj
             obj = self.get(obj_or_id, None, **kws)
             if obj is None:
                 return
-        elif isinstance(obj_or_id, ObjBase):
-            obj = self.get(**obj_or_id._to_pk())
-            if obj is None:
-                return
         else:
             obj = obj_or_id
-        super().remove(obj._obj1)
-
-    def __len__(self):
-        return sum(1 for _ in self.select())
+        if self.table is None:
+            # unbound: forget the pending member, nothing is in the db yet
+            self.__saved[:] = [
+                mix
+                for mix in self.__saved
+                if obj is not mix and obj is not mix._obj1 and obj is not mix._obj2
+            ]
+            return
+        if isinstance(obj, M2MMixObj):
+            rel = obj._obj1
+        elif isinstance(obj, self.table_type.row_type):
+            rel = obj
+        else:
+            # related row: look up the m2m row that links it, no need to select the join
+            rel = self.table.select_one(**self.__from_where(), **self.__to_where(obj))
+            if rel is not None:
+                super().remove(rel)
+            return
+        # m2m rows passed in may link some other source object, leave those alone
+        if rel._matches(self.__from_where()):
+            super().remove(rel)
+
+    def count(self, _where={}, **kws) -> int:
+        """Count members of the m2m list, with a single join select when possible."""
+        where = {**_where, **kws}
+        table, table_2 = self.table, self.table_2
+        if (
+            self.__saved
+            or not self.__can_join(table, table_2)
+            or not where.keys() <= table.field_names
+        ):
+            # members added while unbound are only in ram, related-table keywords need rows
+            return sum(1 for _ in self.select(_where, **kws))
+        db_where, _ = self.__split_where(table, {**where, **self.__from_where()})
+        db = table.db
+        # inner join: m2m rows whose related row is gone aren't members, select skips them too
+        join = db.join(
+            table.table_name, table_2.table_name, on=dict(self.__field_map[1])
+        )
+        fields = [table.table_name + "." + table.row_type._pk[0]]
+        return sum(1 for _ in db.select_gen(join, fields, db_where))
 
     def get(self, _id: T2 = None, _default=None, **kws) -> Optional[ROW_TYPE]:
         """Shortcut method, you can access object by a single pk/positional id."""
         if _id is not None:
             # if you only specify an id, we assume you mean the related-table's pk
             # get-semantics for the related table will pick the right fields
-            self.__resolve_where(kws, side=0, invert=False)
+            kws.update(self.__from_where())
 
-            if self.table_2:
-                if not isinstance(_id, ObjBase):
+            table_2 = self.table_2
+            if table_2 is not None:
+                field_map = self.__field_map[1]
+                if isinstance(_id, ObjBase):
+                    # i'm already a table 2 instance
+                    obj = _id
+                elif len(field_map) == 1 and self.row_type_2._pk == (field_map[0][1],):
+                    # joined on the related pk: the select itself finds the related row
+                    kws[field_map[0][0]] = _id
+                    return self.select_one(**kws) or _default
+                else:
                     # grab by id from table 2
-                    obj = self.table_2.get(_id)
+                    obj = table_2.get(_id)
                     if not obj:
                         return None
-                else:
-                    # i'm already a table 2 instance
-                    obj = _id
                 # then we convert that to a where clause on the m2m table
                 # and merge it in with any other keywords specified
-                self.__resolve_where(kws, side=1, obj=obj, invert=False)
+                kws.update(self.__to_where(obj))
             else:
                 if isinstance(_id, ObjBase):
                     kws.update(_id._to_pk())
-                elif len(self.table_type_2.row_type._pk) == 1:
-                    kws[self.table_type_2.row_type._pk[0]] = _id
+                elif len(self.row_type_2._pk) == 1:
+                    kws[self.row_type_2._pk[0]] = _id
         return self.select_one(**kws) or _default
 
     def __contains__(self, item):
@@ -298,8 +496,10 @@ class M2MHelper(Relation[ROW_TYPE]):
 
         # TODO: relation-with-blocks that track changes, just like their parents.
         """
-        if not manager:
-            manager = self.table.manager
+        # called for every relation on every object commit, usually with nothing saved
+        if not self.__saved:
+            return
+        manager = manager or self.table.manager
         for item in self.__saved:
             if not item._obj1._is_bound:
                 item._obj1._bind(manager=manager)
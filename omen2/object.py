@@ -5,13 +5,22 @@
 
 # pylint: disable=protected-access
 
+import inspect
 import logging
 import threading
 from threading import RLock
-from typing import Type, TYPE_CHECKING, Optional, Tuple, Iterable, Dict, Any, Union
-
-from dataclasses import dataclass
-from contextlib import contextmanager
+from typing import (
+    Type,
+    TYPE_CHECKING,
+    Optional,
+    Tuple,
+    Iterable,
+    Dict,
+    Any,
+    Union,
+    List,
+    FrozenSet,
+)
 
 from .errors import OmenUseWithError, OmenNoPkError, OmenRollbackError, OmenLockingError
 from .relation import Relation
@@ -23,12 +32,29 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
-@dataclass
 class ObjMeta:
     """Object private metadata containing the bound table, a lock, and other flags."""
 
+    # one of these is allocated per row, no need for a __dict__
+    __slots__ = (
+        "lock",
+        "locked",
+        "new",
+        "table",
+        "pk",
+        "lock_id",
+        "suppress_set_changes",
+        "suppress_get_changes",
+        "changes",
+        "in_sync",
+        "up_fds",
+        "relation_names",
+        "pk_tuple",
+    )
+
     def __init__(self):
-        self.lock = RLock()
+        # allocated on first use, most rows are never locked
+        self.lock: Optional[RLock] = None
         self.locked = False
         self.new = True
         self.table: Optional["Table"] = None
@@ -39,10 +65,57 @@ class ObjMeta:
         self.changes: Dict[str, Any] = None
         self.in_sync = False
         self.up_fds = None
+        self.relation_names: Optional[Tuple[str, ...]] = None
+        # memoized _to_pk_tuple(), cleared whenever a pk field may have changed
+        self.pk_tuple: Optional[tuple] = None
+
+
+class _SuppressGetChanges:
+    """Context manager: reads of the object ignore its pending changes."""
+
+    __slots__ = ("obj", "meta")
+
+    def __init__(self, obj: "ObjBase", meta: ObjMeta):
+        self.obj = obj
+        self.meta = meta
+
+    def __enter__(self):
+        self.meta.suppress_get_changes = True
+        return self.obj
+
+    def __exit__(self, *_exc):
+        self.meta.suppress_get_changes = False
+
+
+class _SuppressSetChanges:
+    """Context manager: writes to the object bypass its changeset."""
+
+    __slots__ = ("obj", "meta")
+
+    def __init__(self, obj: "ObjBase", meta: ObjMeta):
+        self.obj = obj
+        self.meta = meta
+
+    def __enter__(self):
+        self.meta.suppress_set_changes = True
+        return self.obj
+
+    def __exit__(self, *_exc):
+        self.meta.suppress_set_changes = False
 
 
 VERY_LARGE_LOCK_TIMEOUT = 120
 
+# guards lazy allocation of per-object locks
+_LOCK_INIT_LOCK = threading.Lock()
+
+_object_get = object.__getattribute__
+
+# immutable values, a write of an equal value of the same type is a no-op
+_SCALAR_TYPES = frozenset((int, float, str, bytes, bool, type(None)))
+_get_ident = threading.get_ident
+
+
 # noinspection PyCallingNonCallable,PyProtectedMember
 class ObjBase:
     """Object base class, from which all objects are derived."""
@@ -53,15 +126,29 @@ class ObjBase:
     _pk: Tuple[str, ...] = ()  # list of field names in the db used as the primary key
     _table_type: Type["Table"]  # class derived from Table
     _sync_on_getattr = False  # maybe don't use this feature, it's an "ipc hack"
+    _is_omen_obj = True  # objects vs. ids, cheaper than isinstance (see M2MHelper)
 
     # objects should only have 1 variable in __dict__
     __meta: ObjMeta = None
 
     # getattr optimization, because python is slow
+    # read with _object_get(self, "_ObjBase__need_attr") on hot paths, which pylint
+    # can't see, so the writes below are marked unused-private-member
     __need_attr: bool = False
 
+    # merged annotations of this class and all of its bases, set in __init_subclass__
+    __annots: Dict[str, Any] = {}
+
+    # attribute names of this class and all of its bases, set in __init_subclass__
+    __class_attrs: FrozenSet[str] = frozenset()
+
+    # false if a pk field is a property: its backing attributes can change the pk
+    # without a write to the pk field itself, set in __init_subclass__
+    __memo_pk: bool = True
+
     def __eq__(self, obj):
-        return obj._to_pk() == self._to_pk()
+        # same result as comparing _to_pk() dicts, but uses the memoized tuples
+        return obj._to_pk_tuple() == _object_get(self, "_to_pk_tuple")()
 
     def __repr__(self):
         return self.__class__.__name__ + "(" + str(self._to_pk(unsafe=True)) + ")"
@@ -71,12 +158,31 @@ class ObjBase:
 
     def __hash__(self):
         try:
-            return hash(self._to_pk_tuple())
+            return hash(_object_get(self, "_to_pk_tuple")())
         except OmenNoPkError:
             return id(self)
 
     def _to_pk_tuple(self):
-        return tuple(sorted(self._to_pk().items()))
+        # memoized, except while locked: the locking thread sees its pending pk changes
+        # (and never for pk properties, see __memo_pk)
+        # (private state via _object_get, skipping my own __getattribute__)
+        meta = _object_get(self, "_ObjBase__meta")
+        cache = meta is not None and not meta.locked
+        if cache and meta.pk_tuple is not None:
+            return meta.pk_tuple
+        dct = _object_get(self, "__dict__")
+        pk = _object_get(self, "_to_pk")()
+        if len(pk) == 1:
+            ret = tuple(pk.items())
+        else:
+            ret = tuple(sorted(pk.items()))
+        if cache and self.__memo_pk:
+            meta.pk_tuple = ret
+            # a commit swaps __dict__ before clearing the memo: if one got in while
+            # the pk was computed from the old dict, the memo may be stale, drop it
+            if _object_get(self, "__dict__") is not dct or meta.locked:
+                meta.pk_tuple = None
+        return ret
 
     def __lt__(self, other: "ObjBase"):
         return self._to_pk_tuple() < other._to_pk_tuple()
@@ -85,6 +191,21 @@ class ObjBase:
         # you must set these in the base class
         assert cls._pk, "All classes must have a _pk"
 
+        # annotations are looked up on every type-checked setattr, so merge them once
+        annots: Dict[str, Any] = {}
+        for c in reversed(cls.mro()):
+            annots.update(vars(c).get("__annotations__", {}))
+        cls.__annots = annots
+
+        # names defined on the class (properties, defaults), for setattr and m2m mixins
+        cls.__class_attrs = frozenset().union(*(vars(c) for c in cls.__mro__))
+
+        # only fields stored in the instance dict can be tracked by __setattr__
+        cls.__memo_pk = not any(
+            inspect.isdatadescriptor(inspect.getattr_static(cls, k, None))
+            for k in cls._pk
+        )
+
     def __init__(self, **kws):
         """Override this to control initialization, generally calling it *after* you do your own init."""
         # even though this is set at the top of __init__, the __meta variable
@@ -99,6 +220,7 @@ class ObjBase:
 
     def _save_pk(self):
         self.__meta.pk = self._to_pk()
+        self.__meta.pk_tuple = None
 
     @property
     def _changes(self):
@@ -108,6 +230,11 @@ class ObjBase:
     def _saved_pk(self):
         return self.__meta.pk
 
+    @classmethod
+    def _class_attr_names(cls) -> FrozenSet[str]:
+        """Names of all attributes defined on the class and its bases."""
+        return cls.__class_attrs
+
     @classmethod
     def _from_db(cls, dct):
         """Override this if you want to change how deserialization works."""
@@ -132,28 +259,35 @@ class ObjBase:
         return ret
 
     def _check_kws(self, dct):
+        if not dct:
+            # the usual case: the subclass __init__ consumed every keyword
+            return
+        own = self.__dict__
         for k in dct:
-            if k not in self.__dict__:
+            if k not in own:
                 raise AttributeError(
                     "%s not a known attribute of %s" % (k, self.__class__.__name__)
                 )
 
     def _matches(self, dct):
+        # no pending changes to show: compare with the instance dict directly
+        if _object_get(self, "_ObjBase__need_attr") or _object_get(
+            self, "_sync_on_getattr"
+        ):
+            own = {}
+        else:
+            own = _object_get(self, "__dict__")
         for k, v in dct.items():
-            if getattr(self, k) != v:
+            if (own[k] if k in own else getattr(self, k)) != v:
                 return False
         return True
 
     def _update_from_object(self, obj):
-        update = {
-            k: v
-            for k, v in obj.__dict__.items()
-            if (
-                (not obj.__meta.up_fds or k in obj.__meta.up_fds)
-                and not isinstance(v, Relation)
-                and not k.startswith("_ObjBase__")
-            )
-        }
+        # only db fields are updated: relations, meta and python-only state are left alone
+        # fields that aren't in the instance dict are properties, their setters will run
+        dct = obj.__dict__
+        fields = obj.__meta.up_fds or self._table_type.field_names_tuple
+        update = {k: dct[k] if k in dct else getattr(obj, k) for k in fields}
         self._atomic_apply(self, update)
 
     def _bind(self, table: "Table" = None, manager: "Omen" = None):
@@ -176,7 +310,12 @@ class ObjBase:
 
     @property
     def _lock(self):
-        return self.__meta.lock
+        meta = self.__meta
+        if meta.lock is None:
+            with _LOCK_INIT_LOCK:
+                if meta.lock is None:
+                    meta.lock = RLock()
+        return meta.lock
 
     @_table.setter
     def _table(self, val):
@@ -186,31 +325,33 @@ class ObjBase:
     def _manager(self):
         return self.__meta.table.manager
 
-    @contextmanager
-    def _suppress_get_changes(self):
-        self.__meta.suppress_get_changes = True
-        yield self
-        self.__meta.suppress_get_changes = False
+    # plain classes, not @contextmanager: these are entered on every serialization
+    def _suppress_get_changes(self) -> _SuppressGetChanges:
+        return _SuppressGetChanges(self, self.__meta)
 
-    @contextmanager
-    def _suppress_set_changes(self):
-        self.__meta.suppress_set_changes = True
-        yield self
-        self.__meta.suppress_set_changes = False
+    def _suppress_set_changes(self) -> _SuppressSetChanges:
+        return _SuppressSetChanges(self, self.__meta)
 
     def _to_db(self, keys: Iterable[str] = None):
         """Get dict of serialized data from self."""
-        ret = {}
-        keys = keys or self._table_type.field_names
-        with self._suppress_get_changes():
-            for k in keys:
-                v = getattr(self, k)
-                if hasattr(v, "_to_db"):
-                    # pylint: disable=no-member
-                    v = v._to_db()
-
-                ret[k] = v
-            return ret
+        # private state via _object_get, skipping my own __getattribute__
+        keys = keys or _object_get(self, "_table_type").field_names_tuple
+        # committed values: straight from the instance dict, getattr only for properties
+        if _object_get(self, "_sync_on_getattr"):
+            dct = {}
+        else:
+            dct = _object_get(self, "__dict__")
+        meta = _object_get(self, "_ObjBase__meta")
+        meta.suppress_get_changes = True
+        try:
+            ret = {k: dct[k] if k in dct else getattr(self, k) for k in keys}
+        finally:
+            meta.suppress_get_changes = False
+        for k, v in ret.items():
+            if hasattr(v, "_to_db"):
+                # pylint: disable=no-member
+                ret[k] = v._to_db()
+        return ret
 
     def _to_pk(self, unsafe=False):
         """Get dict of serialized data from self, but pk elements only.
@@ -227,8 +368,16 @@ class ObjBase:
         The only reason this isn't used by default is efficiency.
         """
         ret = {}
-        for k in self._pk:
-            v = getattr(self, k)
+        # no pending changes to show: read fields straight from the instance dict
+        # (private state via _object_get, skipping my own __getattribute__)
+        if _object_get(self, "_ObjBase__need_attr") or _object_get(
+            self, "_sync_on_getattr"
+        ):
+            dct = None
+        else:
+            dct = _object_get(self, "__dict__")
+        for k in _object_get(self, "_pk"):
+            v = dct[k] if dct is not None and k in dct else getattr(self, k)
             if v is None and not unsafe:
                 raise OmenNoPkError("invalid primary key")
             ret[k] = v
@@ -248,24 +397,28 @@ class ObjBase:
         return need_id_field
 
     def __getattribute__(self, k):
+        # this runs on every attribute read: module-level names, no attribute lookups
+        # read private state via object.__getattribute__, so we don't re-enter this method
         if k[0] == "_":
-            return object.__getattribute__(self, k)
+            return _object_get(self, k)
 
-        if self.__need_attr:
+        if _object_get(self, "_ObjBase__need_attr"):
             # in the middle of making changes, if this is the same thread, make them visible
+            meta = _object_get(self, "_ObjBase__meta")
             if (
-                self.__meta
-                and self.__meta.locked
-                and self.__meta.lock_id == threading.get_ident()
-                and not self.__meta.suppress_get_changes
+                meta
+                and meta.locked
+                and meta.lock_id == _get_ident()
+                and not meta.suppress_get_changes
             ):
-                return self.__meta.changes.get(k, object.__getattribute__(self, k))
+                changes = meta.changes
+                return changes[k] if k in changes else _object_get(self, k)
 
-        if self._sync_on_getattr:
+        if _object_get(self, "_sync_on_getattr"):
             # this should probably never be used, deprecate it
             self._syncattr(k)
 
-        return object.__getattribute__(self, k)
+        return _object_get(self, k)
 
     def _syncattr(self, k):
         if (
@@ -283,19 +436,6 @@ class ObjBase:
             finally:
                 self.__meta.in_sync = False
 
-    @classmethod
-    def __get_type(cls, k) -> Type:  # pylint: disable=unused-private-member
-        if k not in cls.__annotations__:
-            typ = None
-            for c in cls.mro():
-                ann = getattr(c, "__annotations__", {})
-                if k in ann:
-                    typ = ann.get(k, None)
-            # cache result
-            cls.__annotations__[k] = typ
-            return typ
-        return cls.__annotations__[k]
-
     @staticmethod
     def __accept_instance(v, typ):  # pylint: disable=unused-private-member
         if typ is Any:
@@ -323,14 +463,20 @@ class ObjBase:
 
         This only does very basic assertions, and will not check complex types.
         """
-        if not hasattr(self, k):
+        # fields are always in the instance dict, properties are in the class
+        # hasattr (which runs property getters) only for attributes added after class creation
+        if (
+            k not in self.__dict__
+            and k not in self.__class_attrs
+            and not hasattr(self, k)
+        ):
             raise AttributeError("Attribute %s not defined" % k)
         self._checktype(k, v)
 
     def _checktype(self, k, v):
         """Check if type of value is allowed."""
         if self._type_check:
-            typ = self.__get_type(k)
+            typ = self.__annots.get(k)
             if typ:
                 self.__assert_instance(k, v, typ)
 
@@ -339,38 +485,60 @@ class ObjBase:
             object.__setattr__(self, k, v)
             return
 
-        if self.__meta:
-            self._checkattr(k, v)
-        else:
+        meta = self.__meta
+        if not meta:
+            # still constructing (rows loaded from the db land here), nothing to track
             self._checktype(k, v)
+            object.__setattr__(self, k, v)
+            return
 
-        if self.__meta and not self.__meta.suppress_set_changes:
-            if (
-                self.__meta.table is not None
-                and self.__meta.table._in_tx()
-                and not self.__meta.locked
-            ):
-                self.__meta.table._add_object_to_tx(self)
-
-            if self.__meta.table is not None and not self.__meta.locked:
-                raise OmenUseWithError("use with: protocol for bound objects")
-            if (
-                self.__meta.table is not None
-                and self.__meta.lock_id != threading.get_ident()
-            ):
-                raise OmenUseWithError("use with: protocol for bound objects")
+        self._checkattr(k, v)
 
-        if self._is_bound and not self.__meta.suppress_set_changes:
-            self.__meta.changes[k] = v
-            self.__need_attr = True
-        else:
+        table = meta.table
+        if table is None or meta.suppress_set_changes:
             object.__setattr__(self, k, v)
+            if k in self._pk:
+                meta.pk_tuple = None
+            return
+
+        if not meta.locked and table._in_tx():
+            # enters the object's with: block for the rest of the transaction
+            table._add_object_to_tx(self)
+        if not meta.locked or meta.lock_id != _get_ident():
+            raise OmenUseWithError("use with: protocol for bound objects")
+
+        # write straight into the pending-changes dict, applied on commit
+        changes = meta.changes
+        if (changes is None or k not in changes) and type(v) in _SCALAR_TYPES:
+            # re-setting the committed value is not a change
+            # (mutable values can't be skipped, CustomType re-sets itself to flag a change)
+            dct = _object_get(self, "__dict__")
+            if k in dct and type(dct[k]) is type(v) and dct[k] == v:
+                return
+        if changes is None:
+            # allocated on first write, with: blocks that only read never need one
+            changes = meta.changes = {}
+        changes[k] = v
+        self.__need_attr = True  # pylint: disable=unused-private-member
+
+    def _relations(self) -> List[Relation]:
+        """Get the relations held by this object, their names are found once and memoized."""
+        dct = self.__dict__
+        if self.__meta.relation_names is None:
+            self.__meta.relation_names = tuple(
+                k for k, v in dct.items() if isinstance(v, Relation)
+            )
+        return [
+            dct[k]
+            for k in self.__meta.relation_names
+            if isinstance(dct.get(k), Relation)
+        ]
 
     def _get_related(self):
         related = {}
-        for val in self.__dict__.values():
-            if isinstance(val, Relation) and val.cascade:
-                related[val] = list(val.select())
+        for val in self._relations():
+            if val.cascade:
+                related[val] = val._cascade_objs()
         return related
 
     def _collect_cascade(self):
@@ -394,10 +562,26 @@ class ObjBase:
     @staticmethod
     def _atomic_apply(obj, changes: Dict[str, Any]):
         """Atomically apply a dictionary of changes to a python object."""
+        dct = obj.__dict__
+        class_attrs = obj.__class_attrs
+        if type(obj).__setattr__ is ObjBase.__setattr__ and all(
+            k in dct and k not in class_attrs for k in changes
+        ):
+            # plain fields, no setters to trigger: update a copy of the dict directly
+            # still a copy, so a failed commit can swap the old dict back in
+            # values were checked by __setattr__ (or the constructor) on their way in
+            new_dct = dct.copy()
+            with obj._lock:
+                new_dct.update(changes)
+            obj.__dict__ = new_dct  # swap in new dict (atomic)
+            obj.__meta.pk_tuple = None
+            return
+
         tmpobj = obj.__new__(type(obj))  # new obj, no __init__
         tmpobj.__dict__ = obj.__dict__.copy()  # copy all attrs to new obj
         tmpobj._force_apply(changes)
         obj.__dict__ = tmpobj.__dict__  # swap in new dict (atomic)
+        obj.__meta.pk_tuple = None
 
     def _force_apply(self, changes):
         # this happens when the underlying database changes
@@ -419,19 +603,24 @@ class ObjBase:
             # apply changes to new obj, side effects of setters, etc
             changes = self.__meta.changes
             self._atomic_apply(self, changes)
-            self.__meta.changes = {}
-            self.__need_attr = False
-
-        # collect any primary key-cascading updates
-        cascade = self._collect_cascade() if self._cascade else {}
+            self.__meta.changes = None
+            self.__need_attr = False  # pylint: disable=unused-private-member
+
+        # collect any primary key-cascading updates, there are none without relations
+        # in a with: block every write is a change, so a pk with no changes is the same pk
+        relations = self._relations()
+        pk_unchanged = self.__meta.locked and not any(k in changes for k in self._pk)
+        if relations and self._cascade and not pk_unchanged:
+            cascade = self._collect_cascade()
+        else:
+            cascade = {}
 
         # save changes to the db
         self._save(changes, upsert=upsert)
 
         # commit any changes in unbound relations to the db
-        for val in self.__dict__.values():
-            if isinstance(val, Relation):
-                val.commit(self.__meta.table.manager)
+        for val in relations:
+            val.commit(self.__meta.table.manager)
 
         # apply any cascading primary-key changes to the db
         for rel, objs in cascade.items():
@@ -478,29 +667,35 @@ class ObjBase:
 
     def __enter__(self):
         """Lock for write, and trigger thread-isolation."""
-        if self.__meta and self.__meta.table is not None:
-            with self._table.lock:
-                if not self._lock.acquire(timeout=VERY_LARGE_LOCK_TIMEOUT):
+        meta = self.__meta
+        table = meta.table if meta else None
+        if table is not None:
+            with table.lock:
+                lock = self._lock
+                # try without a timeout first, the uncontended case skips the timed wait
+                if not lock.acquire(False) and not lock.acquire(
+                    timeout=VERY_LARGE_LOCK_TIMEOUT
+                ):
                     log.critical("deadlock prevented", stack_info=True)
                     raise OmenLockingError
-                if self.__meta.locked:
+                if meta.locked:
                     # nested with blocks could work, but they are an anti-pattern
-                    self._lock.release()
+                    lock.release()
                     raise OmenLockingError("nested with blocks not supported")
-                self.__meta.locked = True
-                self.__meta.changes = {}
-                self.__need_attr = False
-                self.__meta.lock_id = threading.get_ident()
-                self._table.locked_objs.add(self)
+                meta.locked = True
+                self.__need_attr = False  # pylint: disable=unused-private-member
+                meta.lock_id = _get_ident()
+                table.locked_objs.add(self)
             if self._sync_on_getattr:
-                res = self._table.db_select(self._to_pk())[0]
+                res = table.db_select(self._to_pk())[0]
                 for k, v in res.items():
                     object.__setattr__(self, k, v)
         return self
 
     def __exit__(self, typ, ex, tb):
         """Finished with write, call commit or not, based on exception."""
-        if not self.__meta or not self.__meta.locked:
+        meta = self.__meta
+        if not meta or not meta.locked:
             # unbound objects aren't locked, and don't need the with: protocol
             return False
 
@@ -516,12 +711,12 @@ class ObjBase:
             if typ is OmenRollbackError:
                 return True
         finally:
-            self.__meta.locked = False
-            self.__meta.changes = None
-            self.__need_attr = False
-            self.__meta.lock_id = 0
-            self._lock.release()
-            self._table.locked_objs.discard(self)
+            meta.locked = False
+            meta.changes = None
+            self.__need_attr = False  # pylint: disable=unused-private-member
+            meta.lock_id = 0
+            meta.lock.release()
+            meta.table.locked_objs.discard(self)
 
         return False
 
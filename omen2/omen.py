@@ -131,8 +131,9 @@ class Omen(abc.ABC):
 
         if not getattr(tab, "field_names", None):
             log.debug("%s: default serialization field names used", name)
-            tab.field_names = {c.name for c in self.model[name].columns}
-        assert isinstance(tab.field_names, set)
+            tab.field_names_tuple = tuple(c.name for c in self.model[name].columns)
+            tab.field_names = frozenset(tab.field_names_tuple)
+        assert isinstance(tab.field_names, (set, frozenset))
 
         pk = None
         model = self.model[name]
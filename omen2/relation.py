@@ -47,7 +47,7 @@ class Relation(Selectable[T]):
         """Get bound table."""
         if not self.is_bound():
             return None
-        if not self.__table:
+        if self.__table is None:
             mgr: "Omen" = self._from._table.manager
             self.__table: "Table" = mgr.get_table_by_name(self.table_type.table_name)
             self.table_type = type(self.__table)
@@ -100,8 +100,28 @@ class Relation(Selectable[T]):
             if obj._matches(where):
                 yield obj
 
+    def count(self, _where={}, **kws) -> int:
+        """Count related objects, with a db count if the where clause only has db fields."""
+        table = self.table
+        where = {**_where, **kws, **self._where}
+        if (
+            table is None
+            or self.__saved
+            or table._in_tx()
+            or not where.keys() <= table.field_names
+        ):
+            return super().count(_where, **kws)
+        for k, v in where.items():
+            if callable(v):
+                where[k] = v()
+        return table.count(where)
+
+    def _cascade_objs(self) -> List[T]:
+        """Rows in my table that follow my source object's removes and primary key changes."""
+        return list(self.select())
+
     def _link_obj(self, obj):
-        if self.table:
+        if self.table is not None:
             obj._table = self.table
         with obj:
             for k, v in self._where.items():
@@ -114,6 +134,9 @@ class Relation(Selectable[T]):
 
         TODO: relation-with-blocks that track changes, just like their parents.
         """
+        # called for every relation on every object commit, usually with nothing saved
+        if not self.__saved:
+            return
         if not manager:
             manager = self.table.manager
         for item in self.__saved:
@@ -3,13 +3,31 @@
 
 """Omen2: Table class and supporting types"""
 import contextlib
+import functools
+import inspect
 import threading
 import weakref
 from contextlib import suppress
 from enum import Enum
-from typing import Set, Dict, Iterable, TYPE_CHECKING, TypeVar, Tuple, Generator
-
-from .errors import OmenNoPkError, OmenRollbackError, IntegrityError
+from typing import (
+    Set,
+    Dict,
+    Iterable,
+    TYPE_CHECKING,
+    TypeVar,
+    Tuple,
+    Generator,
+    AbstractSet,
+    Optional,
+    List,
+)
+
+from .errors import (
+    OmenNoPkError,
+    OmenRollbackError,
+    OmenMoreThanOneError,
+    IntegrityError,
+)
 import logging as log
 
 from .selectable import Selectable
@@ -23,6 +41,12 @@ T = TypeVar("T", bound="ObjBase")
 U = TypeVar("U", bound="ObjBase")
 
 
+@functools.lru_cache(maxsize=None)
+def _select_has_limit(db_type: type) -> bool:
+    """True if db_type.select() takes a _limit, older notanorm versions don't."""
+    return "_limit" in inspect.signature(db_type.select).parameters
+
+
 class TxStatus(Enum):
     """Status of objects in per-thread transaction cache.
     UPDATE: object was edited
@@ -43,12 +67,17 @@ class Table(Selectable[T]):
     # pylint: disable=dangerous-default-value, protected-access
 
     table_name: str
-    field_names: Set[str]
+    field_names: AbstractSet[str]
+    field_names_tuple: Tuple[str, ...]  # same names, in column order
     allow_auto: bool = None
 
     def __init_subclass__(cls, *_a, **_kws):
         if hasattr(cls, "row_type"):
             cls.row_type._table_type = cls
+        # keep the ordered names in sync with field_names declared on the class
+        field_names = cls.__dict__.get("field_names")
+        if field_names is not None and "field_names_tuple" not in cls.__dict__:
+            cls.field_names_tuple = tuple(field_names)
 
     def __init__(self, mgr: "Omen"):
         """Bind table to omen manager."""
@@ -109,6 +138,17 @@ class Table(Selectable[T]):
         """Insert an object into the db"""
         return self._add(obj, upsert=False)
 
+    def add_many(self, objs: Iterable[U]) -> List[U]:
+        """Insert several objects into the db, in a single transaction.
+
+        Either all of them are added, or none are.
+        """
+        if self._in_tx():
+            return [self._add(obj, upsert=False) for obj in objs]
+        with self.transaction():
+            ret = [self._add(obj, upsert=False) for obj in objs]
+        return ret
+
     def _add(self, obj: U, upsert: bool) -> U:
         if self._in_tx():
             tid = threading.get_ident()
@@ -252,29 +292,51 @@ class Table(Selectable[T]):
             obj = self.row_type._from_db_not_new(row._asdict())
             pk = obj._to_pk_tuple()
             db_pks.add(pk)
-            if self._in_tx():
-                tid = threading.get_ident()
-                status = self._tx_objs[tid].get(obj, None)
-                if status and status != TxStatus.UPDATE:
-                    continue
-            with self.lock:
-                cached: "ObjBase" = self._cache.get(pk)
-                if cached:
-                    if not cached._is_locked() and obj._to_db() != cached._to_db():
-                        log.debug("updating %r from db", obj)
-                        cached._update_from_object(obj)
-                    obj = cached
-                else:
-                    obj._bind(table=self)
-                    self._add_cache(obj)
-            if obj._matches(attr_where):
+            obj = self._load_obj(obj, pk)
+            if obj is None:
+                continue
+            if not attr_where or obj._matches(attr_where):
                 yield obj
 
         yield from self.__select_intx(where)
 
-        self.__clean_cache(where, db_pks)
+        self._clean_cache(where, db_pks)
 
-    def __clean_cache(self, where, db_pks):
+    def _load_obj(self, obj: T, pk: tuple) -> Optional[T]:
+        """Reconcile an object read from the db with the cache.
+
+        Returns the cached object (updated from the db), or obj bound and cached.
+        Returns None if obj was added or removed in my current transaction.
+        """
+        if self._in_tx():
+            tid = threading.get_ident()
+            status = self._tx_objs[tid].get(obj, None)
+            if status and status != TxStatus.UPDATE:
+                return None
+        with self.lock:
+            cached: "ObjBase" = self._cache.get(pk)
+            if cached:
+                if not cached._is_locked() and obj._to_db() != cached._to_db():
+                    log.debug("updating %r from db", obj)
+                    cached._update_from_object(obj)
+                return cached
+            obj._bind(table=self)
+            self._add_cache(obj)
+        return obj
+
+    def _load_join_row(self, row: dict) -> Optional[T]:
+        """Load my part of a row selected from a join of this table with another.
+
+        Column names shared by both tables are qualified with the table name.
+        """
+        name = self.table_name + "."
+        dct = {
+            f: row[name + f] if name + f in row else row[f] for f in self.field_names
+        }
+        obj = self.row_type._from_db_not_new(dct)
+        return self._load_obj(obj, obj._to_pk_tuple())
+
+    def _clean_cache(self, where, db_pks):
         # remove cached items that are no longer in the db
         remove_from_cache = set()
         for k, v in self._cache.items():
@@ -292,6 +354,29 @@ class Table(Selectable[T]):
         kws.update(_where)
         yield from self.__select(kws, _order_by=_order_by)
 
+    def select_one(self, _where={}, **kws) -> Optional[T]:
+        """Return one row, None, or raises an OmenMoreThanOneError."""
+        where = {**_where, **kws}
+        if (
+            self._in_tx()
+            or not where.keys() <= self.field_names
+            or not _select_has_limit(type(self.db))
+        ):
+            return super().select_one(where)
+        # two rows are enough to know there's more than one
+        rows = self.db.select(self.table_name, None, where, _limit=2)
+        if len(rows) > 1:
+            raise OmenMoreThanOneError
+        obj = None
+        db_pks = set()
+        if rows:
+            obj = self.row_type._from_db_not_new(rows[0]._asdict())
+            pk = obj._to_pk_tuple()
+            db_pks.add(pk)
+            obj = self._load_obj(obj, pk)
+        self._clean_cache(where, db_pks)
+        return obj
+
     def count(self, _where={}, **kws) -> int:
         """Return count of objs matching where clause."""
         kws.update(_where)
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 """Code generation types: imported by all codegen users."""
+import ast
 from typing import Callable
 
 __autodoc__ = False
@@ -11,8 +12,8 @@ from notanorm import DbType
 
 def any_type(arg):
     """Pass-through converter."""
-    # return value as python interpreted
-    return eval(arg)  # pylint: disable=eval-used
+    # return value as a python literal, anything else (function calls, names) is a ValueError
+    return ast.literal_eval(arg)
 
 
 any_type.__name__ = "Any"
@@ -5,7 +5,7 @@ import os
 import sys
 
 from omen2 import Omen
-from omen2.codegen import CodeGen, main
+from omen2.codegen import CodeGen, main, _GEN_CACHE
 from typing import Any, Optional
 
 
@@ -58,6 +58,18 @@ def test_many_types_sqlite(tmp_path):
     assert zap.__annotations__["boolf"] is Optional[bool]
     assert zap.__annotations__["anyold"] is Any
 
+    assert zap._to_db(["id", "nonnull"]) == {"id": None, "nonnull": "val"}
+
+    # rows serialize the field names of their table class, which can be narrowed
+    class ZapRow(mod.zappy_row):
+        pass
+
+    class Zaps(mod.zappy):
+        row_type = ZapRow
+        field_names = {"id", "nonnull"}
+
+    assert ZapRow(nonnull="val")._to_db() == {"id": None, "nonnull": "val"}
+
 
 def test_many_types_mysql(tmp_path):
     out_path = str(tmp_path / "gen.py")
@@ -118,6 +130,60 @@ def test_codegen_pathed(tmp_path):
     assert mod.cars
     assert mod.cars_row
     assert mod.cars_relation
+    assert mod.cars.field_names_tuple == ("id", "color", "gas_level")
+    assert mod.cars.field_names == frozenset(mod.cars.field_names_tuple)
+    assert mod.cars_row.__match_args__ == mod.cars.field_names_tuple
+    sys.modules.pop(mod.__name__)
+
+
+def test_codegen_import_cached(tmp_path):
+    p = str(tmp_path / "gen.py")
+    mod = CodeGen.generate_from_path("tests.schema.MyOmen", out_path=p)
+    cg = CodeGen("tests.schema.MyOmen")
+
+    # unchanged file: same module, no re-exec
+    assert cg.import_generated(p) is mod
+
+    # changed file: re-exec'ed
+    with open(p, "a", encoding="utf8") as f:
+        f.write("\nextra = 1\n")
+    mod2 = cg.import_generated(p)
+    assert mod2 is not mod
+    assert mod2.extra == 1
+
+    # the old module is dropped, one cache entry per generated file
+    assert [k for k in _GEN_CACHE if k[0] == p] == [(p, mod.__name__)]
+
+    # swapped in with os.replace: same size and mtime, but a new inode
+    stat = os.stat(p)
+    with open(p, "r", encoding="utf8") as f:
+        src = f.read()
+    with open(p + ".tmp", "w", encoding="utf8") as f:
+        f.write(src.replace("extra = 1", "extra = 2"))
+    os.utime(p + ".tmp", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(p + ".tmp", p)
+    assert cg.import_generated(p).extra == 2
+    sys.modules.pop(mod.__name__)
+
+
+def test_codegen_skips_unchanged(tmp_path):
+    p = str(tmp_path / "gen.py")
+    CodeGen.generate_from_path("tests.schema.MyOmen", out_path=p)
+    with open(p, "a", encoding="utf8") as f:
+        f.write("\nextra = 1\n")
+
+    # same model: existing file is kept
+    mod = CodeGen.generate_from_path("tests.schema.MyOmen", out_path=p)
+    assert mod.extra == 1
+
+    # stale key: regenerated
+    with open(p, "r", encoding="utf8") as f:
+        lines = f.readlines()
+    lines[0] = "# omen2-codegen: stale\n"
+    with open(p, "w", encoding="utf8") as f:
+        f.writelines(lines)
+    mod = CodeGen.generate_from_path("tests.schema.MyOmen", out_path=p)
+    assert not hasattr(mod, "extra")
     sys.modules.pop(mod.__name__)
 
 
@@ -130,3 +196,37 @@ def test_codegen_main():
 
     assert tests.schema_gen.cars
     os.unlink(tests.schema_gen.__file__)
+
+
+def test_any_type_str_default(tmp_path):
+    out_path = str(tmp_path / "gen.py")
+
+    class Test(Omen):
+        @classmethod
+        def schema(cls, version):
+            return "create table zappy(id integer primary key, anystr default 'abc');"
+
+        dialect = "sqlite"
+
+    mod = Test.codegen(out_path=out_path)
+
+    zap = mod.zappy_row()
+    assert zap.anystr == "abc"
+
+
+def test_bad_str_default(tmp_path):
+    out_path = str(tmp_path / "gen.py")
+
+    class Test(Omen):
+        @classmethod
+        def schema(cls, version):
+            return (
+                "create table zappy(id integer primary key, badstr text default 'a\\');"
+            )
+
+        dialect = "sqlite"
+
+    mod = Test.codegen(out_path=out_path)
+
+    zap = mod.zappy_row()
+    assert zap.badstr is None
@@ -18,7 +18,7 @@ from notanorm.errors import IntegrityError
 
 from omen2 import Omen, ObjBase, Relation, ObjCache
 from omen2.object import CustomType
-from omen2.table import Table
+from omen2.table import Table, _select_has_limit
 from omen2.errors import (
     OmenNoPkError,
     OmenKeyError,
@@ -517,6 +517,22 @@ def test_nopk():
         mgr[gen_objs.doors].add(gen_objs.doors_row(carid=None, type=None))
 
 
+def test_add_many():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    cars = mgr[Cars].add_many(Car(id=i, gas_level=i) for i in range(1, 4))
+    assert [car.id for car in cars] == [1, 2, 3]
+    assert all(car._is_bound for car in cars)
+    assert db.count("cars") == 3
+    assert mgr[Cars].get(2) is cars[1]
+
+    # all or nothing
+    with pytest.raises(IntegrityError):
+        mgr[Cars].add_many([Car(id=4, gas_level=4), Car(id=1, gas_level=1)])
+    assert db.count("cars") == 3
+    assert mgr[Cars].get(4) is None
+
+
 def test_nodup():
     db = SqliteDb(":memory:")
     mgr = MyOmen(db, cars=Cars)
@@ -525,6 +541,152 @@ def test_nodup():
         mgr[Cars].add(Car(id=car.id, gas_level=3))
 
 
+def test_failed_commit_restores():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car1 = mgr[Cars].add(Car(id=1, gas_level=2))
+    mgr[Cars].add(Car(id=2, gas_level=3))
+    with pytest.raises(IntegrityError):
+        with car1:
+            car1.id = 2
+            car1.gas_level = 4
+    assert car1.id == 1
+    assert car1.gas_level == 2
+
+
+def test_db_refresh_keeps_python_state():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car = mgr[Cars].add(Car(id=1, gas_level=2))
+    # python-only state, set in __init__
+    object.__setattr__(car, "not_saved_to_db", "changed")
+    doors = car.doors
+
+    # reread-from db updates db fields only
+    db.update("cars", id=1, gas_level=3)
+    assert mgr[Cars].select_one(id=1) is car
+    assert car.gas_level == 3
+    assert car.not_saved_to_db == "changed"
+    assert car.doors is doors
+
+
+def test_to_db_committed_values():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car = mgr[Cars].add(Car(id=1, gas_level=2))
+    with car:
+        car.gas_level = 3
+        # pending changes are visible to this thread, but not serialized
+        assert car.gas_level == 3
+        assert car._to_db()["gas_level"] == 2
+    assert car._to_db()["gas_level"] == 3
+
+
+def test_set_same_value():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car = mgr[Cars].add(Car(id=1, color="red", gas_level=2))
+    with car:
+        car.color = "red"
+        car.gas_level = 2
+        assert not car._changes
+        # changed and then set back: still written
+        car.color = "blue"
+        car.color = "red"
+        assert car._changes == {"color": "red"}
+        # same value, different type: a change
+        car.gas_level = 2.0
+        assert car._changes["gas_level"] == 2.0
+    assert mgr[Cars].select_one(id=1).color == "red"
+
+
+def test_pk_tuple_follows_changes():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car = Car(id=1, gas_level=2)
+    assert car._to_pk_tuple() == (("id", 1),)
+    car.id = 2
+    assert car._to_pk_tuple() == (("id", 2),)
+    mgr[Cars].add(car)
+    assert mgr[Cars].get(2) is car
+
+    with car:
+        car.id = 3
+        # only this thread sees the pending pk
+        assert car._to_pk_tuple() == (("id", 3),)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(car._to_pk_tuple()))
+        thread.start()
+        thread.join()
+        assert other == [(("id", 2),)]
+    assert hash(car) == hash((("id", 3),))
+
+    with pytest.raises(ValueError):
+        with car:
+            car.id = 4
+            assert car._to_pk_tuple() == (("id", 4),)
+            raise ValueError
+    assert car._to_pk_tuple() == (("id", 3),)
+
+
+def test_pk_tuple_commit_while_computing():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    car = mgr[Cars].add(Car(id=1, gas_level=2))
+    to_pk = Car._to_pk
+    commits = [3]
+
+    def commit_midway(self):
+        pk = to_pk(self)
+        if commits:
+            new_id = commits.pop()
+            # stands in for another thread committing a new pk during the read
+            with self:
+                self.id = new_id
+        return pk
+
+    with patch.object(Car, "_to_pk", commit_midway):
+        assert car._to_pk_tuple() == (("id", 1),)
+    # the old pk isn't memoized over the committed one
+    assert car._to_pk_tuple() == (("id", 3),)
+    assert mgr[Cars].get(3) is car
+
+
+def test_pk_tuple_property():
+    # noinspection PyAbstractClass
+    class Harbinger(Omen):
+        @classmethod
+        def schema(cls, version):
+            return "create table basic (id integer primary key, data text)"
+
+    db = SqliteDb(":memory:")
+
+    class Basic(InlineBasic):
+        _raw_id = None
+
+        @property
+        def id(self):
+            return self._raw_id
+
+        @id.setter
+        def id(self, val):
+            self._raw_id = val
+
+    class Basics(Table[Basic]):
+        pass
+
+    mgr = Harbinger(db, basic=Basics)
+    mgr.basic = Basics(mgr)
+    bas = Basic(id=1, data="x")
+    assert hash(bas) == hash((("id", 1),))
+
+    # writes to the backing attribute change the pk too
+    bas._raw_id = 2
+    assert bas._to_pk_tuple() == (("id", 2),)
+    mgr.basic.add(bas)
+    assert mgr.basic.get(2) is bas
+
+
 def test_need_with():
     db = SqliteDb(":memory:")
     mgr = MyOmen(db, cars=Cars)
@@ -637,6 +799,7 @@ def test_cascade_relations():
         car.id = 3
 
     assert len(car.doors) == 2
+    assert car.doors.count(type="z") == 1
     assert mgr.cars.select_one(id=3)
     assert not mgr.cars.select_one(id=1)
 
@@ -747,6 +910,28 @@ def test_select_any_one():
     assert mgr.cars.select_any_one(gas_level=2)
 
 
+def test_select_one_limit():
+    db = SqliteDb(":memory:")
+    mgr = MyOmen(db, cars=Cars)
+    mgr.cars = mgr[Cars]
+    car = mgr.cars.add(Car(id=1, gas_level=2, color="green"))
+    for i in range(2, 10):
+        mgr.cars.add(Car(id=i, gas_level=2, color="green"))
+
+    with patch.object(db, "select", wraps=db.select) as sel:
+        with pytest.raises(OmenMoreThanOneError):
+            mgr.cars.select_one(gas_level=2)
+        if _select_has_limit(type(db)):
+            # older notanorm versions take the generic select path
+            assert sel.call_args.kwargs["_limit"] == 2
+        assert mgr.cars.select_one(id=1) is car
+
+    # rows deleted behind our back leave the cache
+    db.delete("cars", id=1)
+    assert mgr.cars.select_one(id=1) is None
+    assert (("id", 1),) not in mgr.cars._cache
+
+
 def test_any_type():
     whatever = gen_objs.whatever
     whatever_row = gen_objs.whatever_row